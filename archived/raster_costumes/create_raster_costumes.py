@@ -1,15 +1,18 @@
 #!/usr/bin/env python3
 
+import argparse
+import collections
+import concurrent.futures
+import functools
 import hashlib
 import io
 import json
 import os
-import shutil
-import subprocess
-import tempfile
 import unicodedata
 import zipfile
 
+from PIL import Image, ImageDraw, ImageFont
+
 fonts = [
     {
         'id': 'sans',
@@ -52,6 +55,23 @@ fonts = [
 width = 60 * 4
 height = 80 * 4
 
+# The size (in pixels) that the glyphs are drawn at. ImageMagick's
+# label: would pick the largest size that fit each glyph into the
+# costume, so a '.' came out as big as a 'W'. A single size keeps
+# the glyphs in proportion with each other; this is the same ratio
+# of font size to costume height as the vector costumes use.
+#
+# Some glyphs (such as the replacement character, or a wide 'W')
+# don't fit in the costume at this size, so those alone are drawn
+# smaller, just enough that they fit (see fit_font).
+#
+font_size = int(height * 0.8)
+
+# The dimensions that the glyphs are drawn with. This gets passed
+# to each function that needs it, so the worker processes only
+# work with what they are given.
+RenderConfig = collections.namedtuple('RenderConfig', ['width', 'height', 'font_size'])
+
 # Limitation: costume names must be lower-case
 # Limitation: costume names don't like characters outside of [a-z0-9-], maybe some others
 #
@@ -63,78 +83,194 @@ characters = \
     '0123456789' \
     '`~!@#$€£%^&*()-_=+[{]}\\|;:\'"<,>.?/ '
 
+def name_suffix(character):
+    '''Return the part of the costume name that follows the font id.
+
+    Result might be something like 'a', 'upper-A', '0' or 'special-comma'
+
+    The 'special' characters are given the names from Unicode, some of which seem rather
+    odd and verbose (eg. '/' is 'SOLIDUS' and '-' is 'HYPHEN-MINUS'). We lowercase them
+    and replace anything not a-z0-9 with '-'
+    '''
+
+    if character in 'abcdefghijklmnopqrstuvwxyz0123456789':
+        return character
+
+    if character in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+        return f'upper-{character}'
+
+    name = unicodedata.name(character).lower().replace('_','-').replace(' ','-')
+    return f'special-{name}'
+
+
+# The name suffix for each of the characters (see name_for). These
+# are worked out just the once, here, rather than for every font.
+name_suffixes = {character: name_suffix(character) for character in characters}
+
 replacement_font = '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
 replacement_character = '\uFFFD'  # Unicode replacement character
 
-label_specials = {
-    ' ': 'label:\\ ',
-    '\\': 'label:\\\\'
-}
+# Glyphs drawn by earlier runs are kept in cache_dir, named after
+# their MD5 just as they are in the sprite. cache_index records
+# which (font, character) each of them is for, and the RenderConfig
+# they were drawn with. Bump cache_version whenever a change to the
+# code would draw the glyphs differently, so they get drawn again.
+cache_dir = '.cache'
+cache_index = os.path.join(cache_dir, 'costume_cache.json')
+cache_version = 2
+
+# The input sprite is read through a buffer this big (1 MiB), so
+# ZipFile's small reads of sprite.json are served from a few large
+# reads of the file. This only helps reading: when writing, ZipFile
+# seeks back to fill in each entry's header after writing it, which
+# flushes any write buffer, so a bigger one would gain nothing.
+sprite_buffer_size = 1 << 20
+
+
+def asset_hash():
+    '''Returns a new MD5 hash object, so we can name the asset as expected.
+
+    Scratch refers to each asset by the MD5 of its content (the
+    assetId), and that is also what the asset is named in the
+    sprite3 archive. So although we don't need MD5 for security,
+    it can't be swapped for a faster hash such as BLAKE2.
+    '''
+
+    return hashlib.md5()
+
+
+class HashingWriter(io.RawIOBase):
+    '''A stream that writes to c(f), and also feeds the hash c(h).
+
+    Saving an image through this hashes the image as it is
+    encoded, rather than going back over it afterwards.
+    '''
+
+    def __init__(self, f, h):
+        self.f = f
+        self.h = h
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.h.update(b)
+        return self.f.write(b)
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(filename, size):
+    '''Return the font at c(filename), loaded at c(size).
+
+    Loading a font means parsing the whole file, so each worker
+    process keeps the fonts it has already loaded.
+    '''
+
+    return ImageFont.truetype(filename, size)
+
+
+def fit_font(config, font, character):
+    '''Return c(font) loaded at the size to draw c(character) with.
+
+    That is config.font_size, unless the glyph would then spill
+    outside the costume, in which case it is the largest size at
+    which it fits (leaving a pixel spare at each edge, for the
+    anti-aliasing).
+    '''
+
+    half_width = config.width / 2 - 1
+    half_height = config.height / 2 - 1
+
+    size = config.font_size
+
+    while size > 1:
+
+        loaded_font = load_font(font, size)
+
+        left, top, right, bottom = loaded_font.getbbox(character, anchor='mm')
 
-# These get overwritten in main with more performant and robust settings
-temp_png = 'tmp.png'
-temp_dir = '/tmp/'
+        overflow = max(
+            -left / half_width,
+            right / half_width,
+            -top / half_height,
+            bottom / half_height)
 
+        if overflow <= 1:
+            break
 
-def md5sum_file(filename):
-    '''Returns an MD5 hex-formatted checksum so we can name the file as expected.'''
+        # Jump straight to roughly the right size, but always make
+        # progress; the loop checks that the glyph really does fit.
 
-    with open(filename, 'rb') as f:
-        h = hashlib.md5()
-        h.update(f.read())
-        return h.hexdigest()
+        size = min(size - 1, int(size / overflow))
+
+    return loaded_font
+
+
+def render_glyph(config, font, character):
+    '''Return an image showing c(character) drawn in c(font).
+
+    The character is centered in the image, as ImageMagick's
+    '-gravity center' used to do.
+    '''
 
+    image = Image.new('RGBA', (config.width, config.height), (0, 0, 0, 0))
 
-def generate_glyph(font, name, label):
-    '''Generate the image and costume data for a given character.
+    ImageDraw.Draw(image).text(
+        (config.width / 2, config.height / 2),
+        character,
+        font=fit_font(config, font, character),
+        anchor='mm',
+        fill='black')
+
+    return image
+
+
+def generate_glyph(config, font, character):
+    '''Generate the image for a given character.
 
     To aid in understanding some of the terminology,
     'glyph' is the technical term for the visual representation
     of a 'character' in a given 'font'. In our case we store that
     visual representation ('glyph') as an image in PNG format.
 
-    c(font) is the path to the filename (eg. to a TTF font).
+    c(config) is the RenderConfig to draw the glyph with.
 
-    c(name) is the name you want to give the costume in Scratch.
-    For the Printer project, we use fontid-character, such as
-    'sans-a', but there are limitations in Scratch, such as
-    not being able to have 'sans-A', so we leave that naming
-    detail up to the caller.
+    c(font) is the path to the filename (eg. to a TTF font).
 
-    c(label) is the ImageMagick label that will be passed to
-    the 'convert' program from ImageMagick.
-    
-    For most simple cases, label might be something like
-    'label:a' to write the character 'a', but in more complex
-    cases, such as backslash or space, or some Unicode characters
-    we may need something a bit different.
+    c(character) is the character, in Unicode, that will be
+    drawn.
 
-    The responsibility of correctly formulating the label is
-    left up to the caller.
+    The glyph is drawn with Pillow, in this process, rather
+    than by starting ImageMagick for it, and is hashed as it
+    is encoded as PNG.
     
-    Returns the costume data for the resulting glyph.
+    Returns a (md5hash, data) pair, where c(data) is the PNG
+    image and c(md5hash) is its MD5, which is also what the
+    image will be named after.
     '''
 
-    global width
-    global height
-    global temp_png
-    global temp_dir
-
-    argv = [
-        'convert',
-        '-font', font,
-        '-size', f'{width}x{height}',
-        '-background', 'none',
-        '-gravity', 'center',
-        label,
-        temp_png
-    ]
+    buffer = io.BytesIO()
+    h = asset_hash()
+
+    render_glyph(config, font, character).save(HashingWriter(buffer, h), 'PNG')
+
+    return h.hexdigest(), buffer.getvalue()
 
-    subprocess.check_call(argv)
 
-    md5hash = md5sum_file(temp_png)
+def costume_for(config, name, md5hash):
+    '''Return the costume data for a glyph image.
 
-    shutil.copy(temp_png, os.path.join(temp_dir, f'{md5hash}.png'))
+    c(config) is the RenderConfig the image was drawn with.
+
+    c(name) is the name you want to give the costume in Scratch.
+    For the Printer project, we use fontid-character, such as
+    'sans-a', but there are limitations in Scratch, such as
+    not being able to have 'sans-A', so we leave that naming
+    detail up to the caller.
+
+    c(md5hash) is the MD5 of the image, as returned by
+    generate_glyph.
+    '''
 
     return {
         "assetId": md5hash,
@@ -142,67 +278,229 @@ def generate_glyph(font, name, label):
         "bitmapResolution": 2,
         "md5ext": f"{md5hash}.png",
         "dataFormat": "png",
-        "rotationCenterX": int(width / 2),
-        "rotationCenterY": int(height / 2)
+        "rotationCenterX": int(config.width / 2),
+        "rotationCenterY": int(config.height / 2)
     }
 
 
+def load_cache(config):
+    '''Return the glyphs that earlier runs have left in cache_dir.
+
+    The result is a dict from (font, character) to the MD5 of
+    its image. Glyphs are only returned if they were drawn with
+    the same c(config) and cache_version, and their image is
+    still in cache_dir.
+
+    A missing or unreadable index (eg. one left half-written, or
+    from a different version of this program) is treated just the
+    same as an empty one.
+    '''
+
+    try:
+        with open(cache_index, 'rt', encoding='utf-8') as f:
+            index = json.load(f)
+
+        if index['version'] != cache_version or index['config'] != list(config):
+            return {}
+
+        # List the directory once, rather than checking for each image.
+
+        cached_files = set(os.listdir(cache_dir))
+
+        return {
+            (font, character): md5hash
+            for font, character, md5hash in index['glyphs']
+            if f'{md5hash}.png' in cached_files
+        }
+
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def load_cached_glyph(md5hash):
+    '''Return the (md5hash, data) pair for a glyph in cache_dir.
+
+    This mirrors what generate_glyph returns, so that cached
+    glyphs can be used in just the same way as newly drawn ones.
+    '''
+
+    with open(f'{cache_dir}/{md5hash}.png', 'rb') as f:
+        return md5hash, f.read()
+
+
+def write_cache_file(filename, data):
+    '''Write c(data) to c(filename) in cache_dir.
+
+    The data is written to a new file that then replaces
+    c(filename), so an interrupted run can't leave a half-written
+    file behind under that name.
+    '''
+
+    partial_filename = f'{cache_dir}/{filename}.partial'
+
+    with open(partial_filename, 'wb') as f:
+        f.write(data)
+
+    os.replace(partial_filename, f'{cache_dir}/{filename}')
+
+
+def save_cache(config, images):
+    '''Keep the glyphs in c(images) in cache_dir for the next run.
+
+    c(images) is a dict from (font, character) to the
+    (md5hash, data) pair for its glyph.
+    '''
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    cached_files = set(os.listdir(cache_dir))
+
+    for md5hash, png in images.values():
+
+        if f'{md5hash}.png' not in cached_files:
+            write_cache_file(f'{md5hash}.png', png)
+            cached_files.add(f'{md5hash}.png')
+
+    write_cache_file(os.path.basename(cache_index), json.dumps({
+        'version': cache_version,
+        'config': list(config),
+        'glyphs': [
+            [font, character, md5hash]
+            for (font, character), (md5hash, _) in images.items()
+        ]
+    }).encode('utf-8'))
+
+
 def name_for(font_id, character):
     '''Return a name used for the costume for this character in this font.
     
     Result might be something like 'sans-a', 'sans-upper-a', 'sans-0' or 'sans-special-comma'
 
-    The 'special' characters are given the names from Unicode, some of which seem rather
-    odd and verbose (eg. '/' is 'SOLIDUS' and '-' is 'HYPHEN-MINUS'). We lowercase them
-    and replace anything not a-z0-9 with '-'
+    c(character) needs to be one of the characters; the rest of the name
+    comes from name_suffixes.
 
     This needs to agree with the Scratch code in Printer in the Custom Block
     printer_special_init. It's not used by the user.
     '''
 
-    if character in 'abcdefghijklmnopqrstuvwxyz0123456789':
-        return f'{font_id}-{character}'.lower()
+    return f'{font_id}-{name_suffixes[character]}'
 
-    if character in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
-        return f'{font_id}-upper-{character}'
 
-    name = unicodedata.name(character).lower().replace('_','-').replace(' ','-')
-    return f'{font_id}-special-{name}'.lower()
+def generate_glyph_chunk(config, glyphs):
+    '''Generate the images for a chunk of glyphs.
+
+    c(glyphs) is a list of (font, character) pairs. Returns a list
+    of what generate_glyph returns for each of them, in order.
+
+    Each glyph is cheap to draw, so they are handed to the worker
+    processes in chunks like this; one at a time, the hand-over
+    between processes would cost about as much as the drawing.
+    '''
+
+    return [generate_glyph(config, font, character) for font, character in glyphs]
+
+
+def generate_glyphs(config, jobs):
+    '''Generate the costume data for every glyph in every font.
 
+    The glyphs are generated by up to c(jobs) worker processes
+    at the same time. (costume, data) pairs are yielded in the
+    same order regardless, where c(data) is the PNG image.
 
-def generate_glyphs():
+    Only a small window of chunks (of chunk_size glyphs) is handed
+    to the workers ahead of the glyph being yielded, so the caller
+    can write out each glyph while the workers carry on drawing the
+    next ones.
 
-    global fonts
-    global characters
-    global width
-    global height
-    global label_specials
-    global replacement_font
-    global replacement_character
-    global temp_png
-    global temp_dir
+    Each distinct (font, character) pair is only drawn once, no
+    matter how many costumes use it. The replaceable glyphs, for
+    example, are all drawn in replacement_font. Glyphs that an
+    earlier run has already drawn are read from cache_dir instead.
+    '''
+
+    chunk_size = 16
 
     # We set the currentCostume to 0, so we make the first font's
     # first costume to be the global replaceable.
 
+    glyphs = []
+
     for font in fonts:
-        print(f"Creating {font['id']}")
 
         # First create the 'replaceable' glyph for this font
         # that is show when we don't have a glyph for the
         # desired character.
 
-        yield generate_glyph(
+        glyphs.append((
+            font['id'],
             replacement_font,
             f"{font['id']}-replaceable",
-            f'label:{replacement_character}')
+            replacement_character))
 
         for character in characters:
             
-            yield generate_glyph(
+            glyphs.append((
+                font['id'],
                 font['filename'],
                 name_for(font['id'], character),
-                label_specials.get(character, f'label:{character}'))
+                character))
+
+    cache = load_cache(config)
+
+    if cache:
+        print(f"Reusing {len(cache)} glyphs from {cache_dir}")
+
+    # Split the glyphs that need drawing into chunks, in the order
+    # that they are first needed.
+
+    to_draw = [
+        key
+        for key in dict.fromkeys((font, character) for _, font, _, character in glyphs)
+        if key not in cache
+    ]
+
+    chunks = collections.deque(
+        to_draw[start:start + chunk_size]
+        for start in range(0, len(to_draw), chunk_size))
+
+    window = 2 * jobs
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+
+        # images holds each glyph's (md5hash, data) once it is known.
+        # Cached glyphs are read straight into it, here, rather than
+        # by a worker that would only have to send the data back.
+
+        images = {}
+        in_flight = collections.deque()
+        font_id = None
+
+        for glyph_font_id, font, name, character in glyphs:
+
+            if glyph_font_id != font_id:
+                font_id = glyph_font_id
+                print(f"Creating {font_id}")
+
+            while chunks and len(in_flight) < window:
+                chunk = chunks.popleft()
+                in_flight.append((chunk, executor.submit(generate_glyph_chunk, config, chunk)))
+
+            key = (font, character)
+
+            if key not in images and key in cache:
+                images[key] = load_cached_glyph(cache[key])
+
+            # Chunks are drawn in the order they are needed, so the
+            # glyph we want is in the oldest chunk still in flight.
+
+            while key not in images:
+                chunk, future = in_flight.popleft()
+                images.update(zip(chunk, future.result()))
+
+            md5hash, png = images[key]
+            yield costume_for(config, name, md5hash), png
+
+    save_cache(config, images)
 
 
 def load_sprite_code(sprite3_filename):
@@ -213,8 +511,15 @@ def load_sprite_code(sprite3_filename):
     costumes or sounds.
     '''
 
-    with zipfile.ZipFile(sprite3_filename, 'r') as archive:
-        sprite = json.load(io.BytesIO(archive.read('sprite.json')))
+    with open(sprite3_filename, 'rb', buffering=sprite_buffer_size) as sprite3_file, \
+            zipfile.ZipFile(sprite3_file, 'r') as archive:
+
+        # Every other entry in the archive is a costume or a sound,
+        # so there is nothing else worth reading, or copying across
+        # to the new sprite as it is.
+
+        with archive.open('sprite.json') as f:
+            sprite = json.load(f)
 
         sprite['costumes'] = []
         sprite['current_costume'] = 0
@@ -227,56 +532,99 @@ def load_sprite_code(sprite3_filename):
         return sprite
 
 
-def assemble_sprite(sprite, sprite3_filename):
+def assemble_sprite(sprite, glyphs, sprite3_filename):
+    '''Write the sprite, with a costume for each of c(glyphs).
 
-    global temp_dir
+    c(glyphs) is an iterable of (costume, data) pairs, where
+    c(data) is the content of the costume's asset. Each asset is
+    written into the archive as soon as it is produced, so
+    nothing needs to be staged on disk first.
 
-    with zipfile.ZipFile(sprite3_filename, 'w') as archive:
+    If anything goes wrong, c(sprite3_filename) is left as it was.
+    '''
+
+    # The sprite is written to a new file alongside it, which only
+    # replaces the sprite once it is complete. That way a run that
+    # fails part way through leaves the last good sprite in place.
+
+    partial_filename = f'{sprite3_filename}.partial'
+
+    try:
+        with zipfile.ZipFile(partial_filename, 'w') as archive:
         
-        # Since the files are named after their content (MD5),
-        # we end up getting duplicates when looking at characters
-        # that are in fact the same set picture (and metadata)
-        # such as a space. (someone might decide a space in a
-        # particular font should be done a bit differently, so
-        # we have a space glyph per font.)
+            # Since the files are named after their content (MD5),
+            # we end up getting duplicates when looking at characters
+            # that are in fact the same set picture (and metadata)
+            # such as a space. (someone might decide a space in a
+            # particular font should be done a bit differently, so
+            # we have a space glyph per font.)
+
+            written_files = set()
+            costumes = sprite['costumes']
 
-        written_files = set()
+            for costume, data in glyphs:
 
-        for costume in sprite['costumes']:
+                if costume['md5ext'] not in written_files:
 
-            if costume['md5ext'] not in written_files:
+                    # PNG is already compressed, so compressing it again
+                    # would only cost time.
 
-                archive.write(
-                    os.path.join(temp_dir, costume['md5ext']),
-                    arcname=costume['md5ext'],
-                    compress_type=zipfile.ZIP_STORED)
+                    archive.writestr(
+                        costume['md5ext'],
+                        data,
+                        compress_type=zipfile.ZIP_STORED)
 
-                written_files.add(costume['md5ext'])
+                    written_files.add(costume['md5ext'])
     
-            else:
+                else:
 
-                print(f"Conflict found for new {costume}")
+                    print(f"Conflict found for new {costume}")
 
-        archive.writestr('sprite.json', data=json.dumps(sprite))
+                costumes.append(costume)
 
+            # Scratch has no need for the whitespace, or for non-ASCII
+            # characters to be escaped, so leave both out.
 
-def main():
+            archive.writestr(
+                'sprite.json',
+                data=json.dumps(sprite, separators=(',', ':'), ensure_ascii=False),
+                compress_type=zipfile.ZIP_DEFLATED,
+                compresslevel=6)
+
+    except BaseException:
+        if os.path.exists(partial_filename):
+            os.remove(partial_filename)
+        raise
+
+    os.replace(partial_filename, sprite3_filename)
+
+
+def positive_int(value):
+    '''Parse a command-line argument that must be a whole number of at least 1.'''
 
-    global temp_dir
-    global temp_png
+    number = int(value)
 
-    with tempfile.TemporaryDirectory(prefix='printer-costumes-') as temp_dir:
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {number}')
+
+    return number
+
+
+def main():
 
-        print(f"Using temporary directory {temp_dir}")
+    parser = argparse.ArgumentParser(
+        description='Create raster costumes for the Printer sprite.')
+    parser.add_argument(
+        '-j', '--jobs', type=positive_int, default=os.cpu_count() or 1,
+        help='number of worker processes drawing glyphs (default: number of CPUs)')
+    args = parser.parse_args()
 
-        temp_png = os.path.join(temp_dir, 'tmp.png')
+    config = RenderConfig(width, height, font_size)
 
-        sprite = load_sprite_code('../input/Printer.sprite3')
-        for costume in generate_glyphs():
-            sprite['costumes'].append(costume)
-        assemble_sprite(sprite, '../output/Printer.sprite3')
+    sprite = load_sprite_code('../input/Printer.sprite3')
+    assemble_sprite(sprite, generate_glyphs(config, args.jobs), '../output/Printer.sprite3')
 
-        print("New sprite is ready for upload, available it the output directory")
+    print("New sprite is ready for upload, available it the output directory")
 
 if __name__ == '__main__':
     main()
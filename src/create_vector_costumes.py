@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 
+import collections
+import functools
 import hashlib
-import io
 import json
 import os
-import shutil
-import tempfile
 import unicodedata
 import zipfile
 
@@ -47,6 +46,12 @@ import zipfile
 #     baseline is; but we can fudge that by providing it with
 #     this program, because Scratch only supports a small
 #     number of fonts, and we support only subset of that.
+#
+# We could save Scratch the work of drawing the text by rendering
+# these SVGs to PNG ourselves (eg. with resvg), but that would put
+# us right back where the raster costumes in archived/ were: much
+# larger assets, and glyphs that pixelate when scaled or stamped.
+# Drawing text is something the browser is already good at.
 
 fonts = [
     {
@@ -86,9 +91,29 @@ characters = \
     '0123456789' \
     '`~!@#$€£%^&*()-_=+[{]}\\|;:\'"<,>.?/ '
 
-# These get overwritten in main with more performant and robust settings
-temp_svg = 'tmp.svg'
-temp_dir = '/tmp/'
+def name_suffix(character):
+    '''Return the part of the costume name that follows the font id.
+
+    Result might be something like 'a', 'upper-A', '0' or 'special-comma'
+
+    The 'special' characters are given the names from Unicode, some of which seem rather
+    odd and verbose (eg. '/' is 'SOLIDUS' and '-' is 'HYPHEN-MINUS'). We lowercase them
+    and replace anything not a-z0-9 with '-'
+    '''
+
+    if character in 'abcdefghijklmnopqrstuvwxyz0123456789':
+        return character
+
+    if character in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+        return f'upper-{character}'
+
+    name = unicodedata.name(character).lower().replace('_','-').replace(' ','-')
+    return f'special-{name}'
+
+
+# The name suffix for each of the characters (see name_for). These
+# are worked out just the once, here, rather than for every font.
+name_suffixes = {character: name_suffix(character) for character in characters}
 
 # Essential dimentions of the resulting costume
 #
@@ -104,67 +129,96 @@ temp_dir = '/tmp/'
 width = 40
 height = 50
 
-def svg_letter(character, font):
-    '''Return an SVG document that presents a character in a given font.'''
-
-    # This SVG content was captured by creating a vector costume
-    # in Scratch containing a single letter, aligning it to suit
-    # the origin, making it centered and then exporting it.
-    # And then playing with it some.... no, a LOT. Really, it
-    # ends up looking quite different, and the thumbnail view
-    # (which is more representative of how it appears when used)
-    # ends up looking different from the editor view. Very
-    # hurtful to the brain... probably easier (saner) to make
-    # the simplest SVG you can based on as SVG tutorial.
-
-    # NOTE: Scrach only support some of SVG. Trying to use SVG
-    # images that have been created outside of Scratch 3.0 will
-    # likely end up not displaying correctly. Note that when you
-    # upload a costume, it is stored verbatim. But as soon as
-    # you touch it the Scratch editor will kick in and you'll
-    # end up with a SVG structure that is fairly different.
-
-    global width
-    global height
-
-    # TODO: do this better
-
-    replacements = {
-        '&': '&amp;',
-        '<': '&lt;',
-        '>': '&gt;'
-    }
-
-    if character in replacements:
-        character = replacements[character]
-
-    # The 0.75 is a fudge factor for the descenders. The 'center' in terms of y is half-way between
-    # the baseline and the topline. Naturally, this is something that should really take care
-    # of in font metrics...
+# The dimensions that the costumes are generated with. This gets
+# passed to each function that needs it, rather than having them
+# all reach for the module-level settings.
+RenderConfig = collections.namedtuple('RenderConfig', ['width', 'height'])
+
+# The input sprite is read through a buffer this big (1 MiB), so
+# ZipFile's small reads of sprite.json are served from a few large
+# reads of the file. This only helps reading: when writing, ZipFile
+# seeks back to fill in each entry's header after writing it, which
+# flushes any write buffer, so a bigger one would gain nothing.
+sprite_buffer_size = 1 << 20
+
+# The characters that need to be escaped to be used in SVG text.
+svg_escapes = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;'
+})
+
+# This SVG content was captured by creating a vector costume
+# in Scratch containing a single letter, aligning it to suit
+# the origin, making it centered and then exporting it.
+# And then playing with it some.... no, a LOT. Really, it
+# ends up looking quite different, and the thumbnail view
+# (which is more representative of how it appears when used)
+# ends up looking different from the editor view. Very
+# hurtful to the brain... probably easier (saner) to make
+# the simplest SVG you can based on as SVG tutorial.
+#
+# NOTE: Scrach only support some of SVG. Trying to use SVG
+# images that have been created outside of Scratch 3.0 will
+# likely end up not displaying correctly. Note that when you
+# upload a costume, it is stored verbatim. But as soon as
+# you touch it the Scratch editor will kick in and you'll
+# end up with a SVG structure that is fairly different.
+#
+# The 0.75 is a fudge factor for the descenders. The 'center' in terms of y is half-way between
+# the baseline and the topline. Naturally, this is something that should really take care
+# of in font metrics...
 
-    return f'''
+svg_template = '''
         <svg version="1.1"
             xmlns="http://www.w3.org/2000/svg"
             xmlns:xlink="http://www.w3.org/1999/xlink" width="{width}" height="{height}" viewBox="0,0,{width},{height}">
-            <text x="{width/2}" y="{height*0.75}" font-size="40" xml:space="preserve" fill="#000000" fill-rule="nonzero"
+            <text x="{x}" y="{y}" font-size="40" xml:space="preserve" fill="#000000" fill-rule="nonzero"
                 stroke="none" stroke-width="1" stroke-linecap="butt" stroke-linejoin="miter" stroke-miterlimit="10" stroke-dasharray="" stroke-dashoffset="0"
-                font-family="{font}" font-weight="normal" text-anchor="middle" style="mix-blend-mode: normal">{character}</text>
+                font-family="{{font}}" font-weight="normal" text-anchor="middle" style="mix-blend-mode: normal">{{character}}</text>
         </svg>
         '''
 
-    # <circle cx="{width/2}" cy="{height/2}" r="1" fill="red" />
+# <circle cx="{width/2}" cy="{height/2}" r="1" fill="red" />
 
 
-def md5sum_file(filename):
-    '''Returns an MD5 hex-formatted checksum so we can name the file as expected.'''
+@functools.lru_cache(maxsize=None)
+def svg_template_for(config):
+    '''Return svg_template with the dimensions in c(config) filled in.
+
+    The dimensions are the same for every costume, so this is only
+    done the once; that leaves only the font and character to fill
+    in for each glyph.
+    '''
+
+    return svg_template.format(
+        width=config.width,
+        height=config.height,
+        x=config.width / 2,
+        y=config.height * 0.75)
+
+
+def svg_letter(config, character, font):
+    '''Return an SVG document that presents a character in a given font.'''
+
+    return svg_template_for(config).format(
+        font=font,
+        character=character.translate(svg_escapes))
 
-    with open(filename, 'rb') as f:
-        h = hashlib.md5()
-        h.update(f.read())
-        return h.hexdigest()
 
+def asset_hash():
+    '''Returns a new MD5 hash object, so we can name the asset as expected.
 
-def generate_glyph(font, name, character):
+    Scratch refers to each asset by the MD5 of its content (the
+    assetId), and that is also what the asset is named in the
+    sprite3 archive. So although we don't need MD5 for security,
+    it can't be swapped for a faster hash such as BLAKE2.
+    '''
+
+    return hashlib.md5()
+
+
+def generate_glyph(config, font, name, character):
     '''Generate the image and costume data for a given character.
 
     To aid in understanding some of the terminology,
@@ -172,6 +226,8 @@ def generate_glyph(font, name, character):
     of a 'character' in a given 'font'. In our case we store that
     visual representation ('glyph') as an image in PNG format.
 
+    c(config) is the RenderConfig giving the costume's dimensions.
+
     c(font) is the name of the font as Scratch knows it
     (eg. 'Handwriting').
 
@@ -184,63 +240,48 @@ def generate_glyph(font, name, character):
     c(character) is the character, in Unicode that will be
     displayed. It will be fed verbatim into an SVG Text
     element.
+
+    The SVG is hashed while it is still in memory, and is
+    returned for the caller to write into the sprite.
         
-    Returns the costume data for the resulting glyph.
+    Returns a (costume, data) pair, where c(costume) is the
+    costume data for the resulting glyph and c(data) is the SVG.
     '''
 
-    global width
-    global height
-    global temp_svg
-    global temp_dir
-
-    with open(temp_svg, 'wt', encoding='utf-8') as f:
-        f.write(svg_letter(character, font))
+    svg = svg_letter(config, character, font).encode('utf-8')
 
-    md5hash = md5sum_file(temp_svg)
+    h = asset_hash()
+    h.update(svg)
+    md5hash = h.hexdigest()
 
-    shutil.copy(temp_svg, os.path.join(temp_dir, f'{md5hash}.svg'))
-
-    return {
+    costume = {
         "assetId": md5hash,
         "name": name,
         "md5ext": f"{md5hash}.svg",
         "dataFormat": "svg",
-        "rotationCenterX": int(width / 2),
-        "rotationCenterY": int(height / 2)
+        "rotationCenterX": int(config.width / 2),
+        "rotationCenterY": int(config.height / 2)
     }
 
+    return costume, svg
+
 
 def name_for(font_id, character):
     '''Return a name used for the costume for this character in this font.
     
     Result might be something like 'sans-a', 'sans-upper-a', 'sans-0' or 'sans-special-comma'
 
-    The 'special' characters are given the names from Unicode, some of which seem rather
-    odd and verbose (eg. '/' is 'SOLIDUS' and '-' is 'HYPHEN-MINUS'). We lowercase them
-    and replace anything not a-z0-9 with '-'
+    c(character) needs to be one of the characters; the rest of the name
+    comes from name_suffixes.
 
     This needs to agree with the Scratch code in Printer in the Custom Block
     printer_special_init. It's not used by the user.
     '''
 
-    if character in 'abcdefghijklmnopqrstuvwxyz0123456789':
-        return f'{font_id}-{character}'.lower()
-
-    if character in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
-        return f'{font_id}-upper-{character}'
-
-    name = unicodedata.name(character).lower().replace('_','-').replace(' ','-')
-    return f'{font_id}-special-{name}'.lower()
-
+    return f'{font_id}-{name_suffixes[character]}'
 
-def generate_glyphs():
 
-    global fonts
-    global characters
-    global width
-    global height
-    global temp_svg
-    global temp_dir
+def generate_glyphs(config):
 
     # We set the currentCostume to 0, so we make the first font's
     # first costume to be the global replaceable.
@@ -255,6 +296,7 @@ def generate_glyphs():
         # case-sensitivity testing.
 
         yield generate_glyph(
+            config,
             font['fontname'],
             f'{font["id"]}-replaceable',
             '\uFFFD')
@@ -262,6 +304,7 @@ def generate_glyphs():
         for character in characters:
             
             yield generate_glyph(
+                config,
                 font['fontname'],
                 name_for(font['id'], character),
                 character)
@@ -275,8 +318,15 @@ def load_sprite_code(sprite3_filename):
     costumes or sounds.
     '''
 
-    with zipfile.ZipFile(sprite3_filename, 'r') as archive:
-        sprite = json.load(io.BytesIO(archive.read('sprite.json')))
+    with open(sprite3_filename, 'rb', buffering=sprite_buffer_size) as sprite3_file, \
+            zipfile.ZipFile(sprite3_file, 'r') as archive:
+
+        # Every other entry in the archive is a costume or a sound,
+        # so there is nothing else worth reading, or copying across
+        # to the new sprite as it is.
+
+        with archive.open('sprite.json') as f:
+            sprite = json.load(f)
 
         sprite['costumes'] = []
         sprite['current_costume'] = 0
@@ -289,56 +339,82 @@ def load_sprite_code(sprite3_filename):
         return sprite
 
 
-def assemble_sprite(sprite, sprite3_filename):
+def assemble_sprite(sprite, glyphs, sprite3_filename):
+    '''Write the sprite, with a costume for each of c(glyphs).
+
+    c(glyphs) is an iterable of (costume, data) pairs, where
+    c(data) is the content of the costume's asset. Each asset is
+    written into the archive as soon as it is produced, so
+    nothing needs to be staged on disk first.
 
-    global temp_dir
+    If anything goes wrong, c(sprite3_filename) is left as it was.
+    '''
+
+    # The sprite is written to a new file alongside it, which only
+    # replaces the sprite once it is complete. That way a run that
+    # fails part way through leaves the last good sprite in place.
 
-    with zipfile.ZipFile(sprite3_filename, 'w') as archive:
+    partial_filename = f'{sprite3_filename}.partial'
+
+    try:
+        with zipfile.ZipFile(partial_filename, 'w') as archive:
         
-        # Since the files are named after their content (MD5),
-        # we end up getting duplicates when looking at characters
-        # that are in fact the same set picture (and metadata)
-        # such as a space. (someone might decide a space in a
-        # particular font should be done a bit differently, so
-        # we have a space glyph per font.)
+            # Since the files are named after their content (MD5),
+            # we end up getting duplicates when looking at characters
+            # that are in fact the same set picture (and metadata)
+            # such as a space. (someone might decide a space in a
+            # particular font should be done a bit differently, so
+            # we have a space glyph per font.)
+
+            written_files = set()
+            costumes = sprite['costumes']
 
-        written_files = set()
+            for costume, data in glyphs:
 
-        for costume in sprite['costumes']:
+                if costume['md5ext'] not in written_files:
 
-            if costume['md5ext'] not in written_files:
+                    # SVG is plain (and rather repetitive) text, so it
+                    # compresses well.
 
-                archive.write(
-                    os.path.join(temp_dir, costume['md5ext']),
-                    arcname=costume['md5ext'],
-                    compress_type=zipfile.ZIP_STORED)
+                    archive.writestr(
+                        costume['md5ext'],
+                        data,
+                        compress_type=zipfile.ZIP_DEFLATED,
+                        compresslevel=6)
 
-                written_files.add(costume['md5ext'])
+                    written_files.add(costume['md5ext'])
     
-            else:
+                else:
 
-                print(f"Conflict found for new {costume}")
+                    print(f"Conflict found for new {costume}")
 
-        archive.writestr('sprite.json', data=json.dumps(sprite))
+                costumes.append(costume)
 
+            # Scratch has no need for the whitespace, or for non-ASCII
+            # characters to be escaped, so leave both out.
 
-def main():
+            archive.writestr(
+                'sprite.json',
+                data=json.dumps(sprite, separators=(',', ':'), ensure_ascii=False),
+                compress_type=zipfile.ZIP_DEFLATED,
+                compresslevel=6)
+
+    except BaseException:
+        if os.path.exists(partial_filename):
+            os.remove(partial_filename)
+        raise
 
-    global temp_dir
-    global temp_svg
+    os.replace(partial_filename, sprite3_filename)
 
-    with tempfile.TemporaryDirectory(prefix='printer-costumes-') as temp_dir:
 
-        print(f"Using temporary directory {temp_dir}")
+def main():
 
-        temp_svg = os.path.join(temp_dir, 'tmp.png')
+    config = RenderConfig(width, height)
 
-        sprite = load_sprite_code('../input/Printer.sprite3')
-        for costume in generate_glyphs():
-            sprite['costumes'].append(costume)
-        assemble_sprite(sprite, '../output/Printer.sprite3')
+    sprite = load_sprite_code('../input/Printer.sprite3')
+    assemble_sprite(sprite, generate_glyphs(config), '../output/Printer.sprite3')
 
-        print("New sprite is ready for upload, available it the output directory")
+    print("New sprite is ready for upload, available it the output directory")
 
 
 if __name__ == '__main__':